@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""Benchmarks for FaceCube and GesturePrinter
+
+Times the per-frame thresholding, segmentation and hole filling in FaceCube,
+saving a PLY with PlyWriter, and pushing moves through GCodeGenerator to a
+fake serial port.  Depth frames are synthetic (a sphere in front of a flat
+background, with and without sensor noise) plus any recorded frames given
+on the command line, saved with numpy.save.
+
+Results can be saved as JSON and compared against an earlier run, so the
+speed of a change can be checked across commits.
+
+Usage: python benchmark.py [-o results.json] [-c baseline.json] [-t 0.1]
+                           [-r recorded.npy ...]
+"""
+
+import sys
+import os
+import timeit
+import json
+import tempfile
+import subprocess
+from optparse import OptionParser
+import numpy
+from facecube import FaceCube, PlyWriter
+
+size = (640, 480)
+# raw Kinect depth of the background plane and the front of the sphere
+background_depth = 950
+sphere_depth = 700
+sphere_radius = 120
+
+def sphere_frame():
+    """a sphere in the middle of the view in front of a flat background"""
+    x, y = numpy.mgrid[0:size[0],0:size[1]]
+    r2 = (x - size[0]/2)**2 + (y - size[1]/2)**2
+    inside = r2 < sphere_radius**2
+    height = numpy.sqrt(numpy.maximum(sphere_radius**2 - r2, 0))
+    frame = numpy.empty(size, dtype=numpy.uint16)
+    frame.fill(background_depth)
+    frame[inside] = (sphere_depth + sphere_radius - height[inside]).astype(numpy.uint16)
+    return frame
+
+def noisy_frame(frame, seed):
+    """adds jitter, dropped out pixels and stray close pixels like the Kinect's"""
+    random = numpy.random.RandomState(seed)
+    frame = (frame.astype(int) + random.randint(-2, 3, size)).astype(numpy.uint16)
+    frame[random.random_sample(size) < 0.02] = 2047
+    frame[random.random_sample(size) < 0.0005] = 520
+    return frame
+
+def empty_frame(seed):
+    frame = numpy.empty(size, dtype=numpy.uint16)
+    frame.fill(background_depth)
+    return noisy_frame(frame, seed)
+
+def fixtures(recorded):
+    frames = {'sphere': sphere_frame()}
+    frames['noisy'] = noisy_frame(frames['sphere'], 0)
+    for filename in recorded:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        frames[name] = numpy.load(filename)
+    return frames
+
+def best_time(function, repeat):
+    """shortest wall time of repeat calls, in seconds"""
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        function()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_facecube(name, frame, background, repeat):
+    results = {}
+    facecube = FaceCube(frame)
+    center = (frame.shape[0]//2, frame.shape[1]//2)
+
+    def threshold():
+        facecube.depth = frame
+        facecube.generate_threshold(10.0)
+    results[name + '.generate_threshold'] = best_time(threshold, repeat)
+
+    facecube.learn_background(background)
+    def foreground():
+        facecube.depth = frame
+        facecube.generate_foreground()
+    results[name + '.generate_foreground'] = best_time(foreground, repeat)
+
+    # stray pixels in the noisy frames throw off generate_threshold, so
+    # segment the foreground to be sure there is an object at the center
+    foreground()
+    facecube.select_segment(center)
+    results[name + '.segment'] = best_time(facecube.segment, repeat)
+
+    def hole_fill():
+        facecube.segment()
+        facecube.hole_fill(5)
+    results[name + '.hole_fill'] = best_time(hole_fill, repeat)
+    return results
+
+def bench_plywriter(name, frame, background, repeat):
+    # segment the foreground, as bench_facecube does, so the noisy frames
+    # save the sphere rather than a handful of stray pixels
+    facecube = FaceCube(frame)
+    facecube.learn_background(background)
+    facecube.generate_foreground()
+    facecube.select_segment((frame.shape[0]//2, frame.shape[1]//2))
+    facecube.segment()
+    array = facecube.get_array()
+    handle, filename = tempfile.mkstemp(suffix='.ply')
+    os.close(handle)
+    try:
+        writer = PlyWriter(filename)
+        seconds = best_time(lambda: writer.save(array, False), repeat)
+    finally:
+        os.remove(filename)
+    return {name + '.plywriter_save': seconds}
+
+class FakeSerial(object):
+    """stands in for RepRapArduinoSerialSender, accepting every move at once"""
+    def __init__(self):
+        self.moves = 0
+
+    def write(self, block):
+        self.moves += 1
+
+def bench_gcode(moves, repeat):
+    from gestureprinter import GCodeGenerator
+
+    def run():
+        generator = GCodeGenerator(FakeSerial(), False)
+        generator.connect()
+        for i in range(moves):
+            if i % 1000 == 999:
+                generator.new_layer(None)
+            generator.add_move((i % 80, 0.0), ((i + 1) % 80, 10.0), i % 2)
+        generator.disconnect()
+    # reported per move rather than per run so move counts can change
+    return {'gcode.per_move': best_time(run, repeat) / moves}
+
+def git_revision():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                cwd=sys.path[0]).communicate()[0].strip()
+    except OSError:
+        return None
+
+def compare(results, baseline, threshold):
+    """prints the change from baseline for each benchmark. returns the names
+    of benchmarks that got slower by more than threshold.  benchmarks too
+    fast for the timer to measure in the baseline can't be compared"""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        if baseline[name] <= 0.0:
+            print '%-40s %8s' % (name, 'skipped')
+            continue
+        change = results[name] / baseline[name] - 1.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print '%-40s %+7.1f%%%s' % (name, change * 100, flag)
+    return regressions
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='python benchmark.py [options]')
+    parser.add_option('-o', '--output', help='save the results as JSON to this file')
+    parser.add_option('-c', '--compare', help='compare against results saved by an earlier run')
+    parser.add_option('-t', '--threshold', type='float', default=0.1,
+                      help='fraction slower than the baseline that counts as a regression')
+    parser.add_option('-r', '--recorded', action='append', default=[],
+                      help='a recorded depth frame saved with numpy.save, may be repeated')
+    parser.add_option('-n', '--repeat', type='int', default=5,
+                      help='number of runs to take the best time from')
+    parser.add_option('-m', '--moves', type='int', default=10000,
+                      help='number of moves to send through GCodeGenerator')
+    parser.add_option('--no-gcode', action='store_true',
+                      help='skip GCodeGenerator, which needs pygame and OSC to import')
+    (options, args) = parser.parse_args()
+
+    background = [empty_frame(seed) for seed in range(1, 6)]
+    results = {}
+    for (name, frame) in sorted(fixtures(options.recorded).items()):
+        results.update(bench_facecube(name, frame, background, options.repeat))
+        results.update(bench_plywriter(name, frame, background, options.repeat))
+    if not options.no_gcode:
+        results.update(bench_gcode(options.moves, options.repeat))
+
+    for name in sorted(results):
+        print '%-40s %10.6f s' % (name, results[name])
+
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump({'revision': git_revision(), 'results': results}, f, indent=2, sort_keys=True)
+        f.close()
+
+    if options.compare:
+        f = open(options.compare)
+        baseline = json.load(f)['results']
+        f.close()
+        print ' '
+        regressions = compare(results, baseline, options.threshold)
+        if regressions:
+            print '%d benchmarks slower than %s by more than %d%%' % (len(regressions),
+                options.compare, options.threshold * 100)
+            sys.exit(1)
@@ -27,124 +27,276 @@ FaceCube - Does the actual capture, thresholding, and segmentation
 
 import sys
 import subprocess
-import freenect
+import multiprocessing
 import numpy
 import scipy
 import scipy.ndimage
 
 class PlyWriter(object):
     """Writes out the point cloud in the PLY file format
-    http://en.wikipedia.org/wiki/PLY_%28file_format%29"""
+    http://en.wikipedia.org/wiki/PLY_%28file_format%29
+    
+    Points are generated and written a band of rows at a time, so memory use
+    does not grow with the size of the depth image"""
+    
+    # number of pixels of the depth image to turn into points at once, rounded
+    # to whole rows so wider frames get fewer rows per band
+    band_pixels = 32 * 480
+    # depth camera intrinsics in pixels for a calibration_size image, from
+    # http://nicolas.burrus.name/index.php/Research/KinectCalibration
+    fx = 594.21
+    fy = 591.04
+    cx = 339.31
+    cy = 242.74
+    # transposed like FaceCube's frames, so x comes first
+    calibration_size = (640, 480)
+    # ray directions shared by every writer, only rebuilt when the intrinsics
+    # or resolution change
+    ray_cache = None
+    ray_cache_key = None
        
     def __init__(self,name):
         self.name =  name
-        # depth to calculate x and y from, to keep a uniform perspective
-        self.z_p = 0
         
-    def to_world(self, point):
-        x_out = float(point[0] - self.dims[0] / 2) * self.scale
-        y_out = float(point[1] - self.dims[1] / 2) * self.scale
-        return (x_out, y_out)
+    def intrinsics(self,resolution):
+        """fx, fy, cx and cy scaled to a full frame of the given resolution, so
+        higher resolution or super-resolved frames are projected correctly"""
+        if resolution[0] * self.calibration_size[1] != resolution[1] * self.calibration_size[0]:
+            raise ValueError("depth frame is %dx%d, which isn't the shape of a transposed "
+                             "%dx%d Kinect frame" % (tuple(resolution) + self.calibration_size))
+        scale = float(resolution[0]) / self.calibration_size[0]
+        # scale about pixel edges rather than pixel centers
+        return (self.fx * scale, self.fy * scale,
+                (self.cx + 0.5) * scale - 0.5, (self.cy + 0.5) * scale - 0.5)
         
-    def save(self,array,leave_holes):
-        points = []
+    def ray_vectors(self,resolution):
+        """x of the ray through each row and y of the ray through each column of
+        the full frame, per mm of depth.  x only depends on the row and y only
+        on the column, so these broadcast to the ray through every pixel"""
+        key = (self.fx, self.fy, self.cx, self.cy, tuple(resolution))
+        if PlyWriter.ray_cache_key != key:
+            (fx, fy, cx, cy) = self.intrinsics(resolution)
+            PlyWriter.ray_cache = ((numpy.arange(resolution[0]) - cx) / fx,
+                                   (numpy.arange(resolution[1]) - cy) / fy)
+            PlyWriter.ray_cache_key = key
+        return PlyWriter.ray_cache
         
+    def to_world(self, point, z):
+        """back-projects pixel coordinates at z mm deep into x and y in mm.
+        works on single pixel coordinates or arrays of them"""
+        return (self.x_rays[point[0]] * z, self.y_rays[point[1]] * z)
+        
+    def save(self,array,leave_holes,offset=(0,0),resolution=None):
+        """resolution is the shape of the full frame array was taken from and
+        offset is where array starts in it.  they default to array being the
+        full frame"""
+        if resolution is None:
+            resolution = array.shape
+        self.dims = array.shape
+        if offset[0] + self.dims[0] > resolution[0] or offset[1] + self.dims[1] > resolution[1]:
+            raise ValueError("a %dx%d array at %s doesn't fit in a %dx%d frame" %
+                             (self.dims + (offset,) + tuple(resolution)))
         farthest = numpy.amax(array)
         farthest_mm = 1000.0/(-0.00307 * farthest + 3.33)
-        self.z_p = farthest_mm
-        self.dims = array.shape
-        minDistance = -100
-        scaleFactor = 0.0021
-        self.scale = float(self.z_p + minDistance) * scaleFactor
-        
-        a = numpy.argwhere(array)
-        min_point, max_point = a.min(0), a.max(0) + 1
-        min_point = self.to_world(min_point)
-        max_point = self.to_world(max_point)
+        (x_rays, y_rays) = self.ray_vectors(resolution)
+        self.x_rays = x_rays[offset[0]:offset[0] + self.dims[0]]
+        self.y_rays = y_rays[offset[1]:offset[1] + self.dims[1]]
+        (fx, fy) = self.intrinsics(resolution)[:2]
+        
+        self.holes = None
+        if not leave_holes:
+            self.holes = self.find_holes(array)
+        
+        # count every point up front so the header can go out before the
+        # points, and find which rows and columns the object covers
+        count = 0
+        rows = numpy.zeros(self.dims[0], bool)
+        cols = numpy.zeros(self.dims[1], bool)
+        for (start, end, mask, outline) in self.mask_bands(array):
+            occupied = array[start:end] != 0
+            rows[start:end] = numpy.any(occupied, 1)
+            cols |= numpy.any(occupied, 0)
+            count += self.outline_count(outline,farthest)
+            count += numpy.count_nonzero(mask)
+            count += numpy.count_nonzero(occupied)
+        
+        rows = numpy.flatnonzero(rows)
+        cols = numpy.flatnonzero(cols)
+        min_point = self.to_world((rows[0], cols[0]), farthest_mm)
+        max_point = self.to_world((rows[-1], cols[-1]), farthest_mm)
+        # the far edge of the last pixel rather than its corner
+        pixel = (farthest_mm / fx, farthest_mm / fy)
+        max_point = (max_point[0] + pixel[0], max_point[1] + pixel[1])
         center_mm = ((min_point[0]+max_point[0])/2.0,(min_point[1]+max_point[1])/2)
         size_mm = (max_point[0]-min_point[0],max_point[1]-min_point[1])
-
-        points.extend(self.outline_points(array,farthest,leave_holes))
-        points.extend(self.back_points(array,farthest,leave_holes))
-        points.extend(self.mesh_points(array))
         
         f = open(self.name,'w')
         
-        self.write_header(f,points)
-        self.write_points(f,points,farthest_mm,center_mm)
+        self.write_header(f,count)
+        self.write_points(f,self.solid_points(array,farthest),farthest_mm,center_mm)
+        self.write_points(f,self.mesh_points(array),farthest_mm,center_mm)
         
         f.close()
         
         return size_mm
         
-    # inspired by, but not based on http://borglabs.com/blog/create-point-clouds-from-kinect
-    def mesh_points(self,array):
-        points = []
+    def bands(self):
+        """yields the start and end row of each band of the image"""
+        rows = max(1, self.band_pixels // self.dims[1])
+        for start in xrange(0,self.dims[0],rows):
+            yield (start, min(start + rows, self.dims[0]))
+            
+    def find_holes(self,array):
+        """does what binary_fill_holes does to the whole image a band at a time.
+        the background of each band is labelled, and labels that touch across
+        bands are joined up.  returns the first label of each band, and which
+        labels are holes, meaning background that never reaches the edge"""
+        parent = [0]
         
+        def root(label):
+            while parent[label] != label:
+                parent[label] = parent[parent[label]]
+                label = parent[label]
+            return label
+        
+        firsts = []
+        edge = set()
+        previous = None
+        for (start, end) in self.bands():
+            (labels, num_labels) = scipy.ndimage.measurements.label(array[start:end] == 0)
+            first = len(parent) - 1
+            parent.extend(range(first + 1, first + num_labels + 1))
+            labels = numpy.where(labels, labels + first, 0)
+            firsts.append(first)
+            
+            edge.update(numpy.unique(labels[:,0]))
+            edge.update(numpy.unique(labels[:,-1]))
+            if start == 0:
+                edge.update(numpy.unique(labels[0]))
+            if end == self.dims[0]:
+                edge.update(numpy.unique(labels[-1]))
+            if previous is not None:
+                touching = (previous != 0) & (labels[0] != 0)
+                for (above, below) in set(zip(previous[touching], labels[0][touching])):
+                    parent[root(above)] = root(below)
+            previous = labels[-1]
+        
+        roots = numpy.array([root(label) for label in range(len(parent))])
+        reaches_edge = numpy.zeros(len(parent), bool)
+        reaches_edge[roots[numpy.array(sorted(edge), dtype=int)]] = True
+        holes = ~reaches_edge[roots]
+        holes[0] = False
+        return (firsts, holes)
+        
+    def filled_bands(self,array):
+        """yields the start and end row and mask of each band, with holes
+        filled in unless leave_holes was set"""
+        for (index, (start, end)) in enumerate(self.bands()):
+            mask = array[start:end] != 0
+            if self.holes is not None:
+                (firsts, holes) = self.holes
+                (labels, num_labels) = scipy.ndimage.measurements.label(~mask)
+                mask |= holes[numpy.where(labels, labels + firsts[index], 0)]
+            yield (start, end, mask)
+            
+    def mask_bands(self,array):
+        """yields the start and end row, mask and outline of each band.  the
+        mask is eroded against the rows either side of the band to find the
+        outline, so this looks one band ahead"""
+        bands = self.filled_bands(array)
+        above = numpy.zeros(self.dims[1], bool)
+        current = next(bands, None)
+        while current is not None:
+            following = next(bands, None)
+            (start, end, mask) = current
+            if following is None:
+                below = numpy.zeros(self.dims[1], bool)
+            else:
+                below = following[2][0]
+            eroded = scipy.ndimage.morphology.binary_erosion(numpy.vstack((above, mask, below)))[1:-1]
+            outline = array[start:end] * (mask & ~eroded)
+            yield (start, end, mask, outline)
+            above = mask[-1]
+            current = following
+            
+    def band_points(self,band,start):
+        """an (n,3) array of points for the nonzero depths in a band"""
+        (i, j) = numpy.nonzero(band)
         # depth approximation from ROS, in mm
-        array = (array != 0) * 1000.0/(-0.00307 * array + 3.33)
-        
-        for i in range(0,self.dims[0]):
-            for j in range(0,self.dims[1]):
-                z = array[i,j]
-                if z:
-                    # from http://openkinect.org/wiki/Imaging_Information
-                    (x, y) = self.to_world((i, j))
-                    points.append((x,y,z))
-                    
-        return points
+        z = 1000.0/(-0.00307 * band[i,j] + 3.33)
+        (x, y) = self.to_world((i + start, j), z)
+        return numpy.column_stack((x,y,z))
+        
+    # inspired by, but not based on http://borglabs.com/blog/create-point-clouds-from-kinect
+    def mesh_points(self,array):
+        """yields an (n,3) array of points for each band of the image"""
+        for (start, end) in self.bands():
+            yield self.band_points(array[start:end], start)
+            
+    def outline_count(self,outline,depth):
+        """number of points outline_points will generate for a band"""
+        z = outline[outline != 0].astype(int)
+        return numpy.sum(numpy.maximum(int(depth) - z - 1, 0))
         
-    def outline_points(self,array,depth,leave_holes):
+    def solid_points(self,array,depth):
+        """yields the outline and back plane points of each band, so the
+        banded hole filling and erosion only has to be done once for both"""
+        for (start, end, mask, outline) in self.mask_bands(array):
+            yield self.outline_points(outline,start,depth)
+            yield self.back_points(mask,start,depth)
+            
+    def outline_points(self,outline,start,depth):
         """Adds an outline going back to the farthest depth to give MeshLab an
         easier point cloud to turn into a solid"""
-        points = []
+        (i, j) = numpy.nonzero(outline)
+        z = outline[i,j].astype(int)
+        # one point per depth step between the outline and the farthest depth
+        steps = numpy.maximum(int(depth) - z - 1, 0)
+        offsets = numpy.arange(numpy.sum(steps)) - numpy.repeat(numpy.cumsum(steps) - steps, steps)
+        i = numpy.repeat(i, steps)
+        j = numpy.repeat(j, steps)
+        z = numpy.repeat(z, steps) + 1 + offsets
+        z_mm = 1000.0/(-0.00307 * z + 3.33)
+        (x, y) = self.to_world((i + start, j), z_mm)
+        return numpy.column_stack((x,y,z_mm))
         
-        mask = array != 0
-        if not leave_holes:
-            scipy.ndimage.morphology.binary_fill_holes(mask, output=mask)
-        outline = array * (mask - scipy.ndimage.morphology.binary_erosion(mask))
-        
-        for i in range(0,self.dims[0]):
-            for j in range(0,self.dims[1]):
-                z = outline[i,j]
-                if z:
-                    z += 1
-                    while z < depth:
-                        z_mm = 1000.0/(-0.00307 * z + 3.33)
-                        (x, y) = self.to_world((i, j))
-                        points.append((x,y,z_mm))
-                        z += 1
-        
-        return points
-        
-    def back_points(self,array,depth,leave_holes):
+    def back_points(self,mask,start,depth):
         """Adds a plane of points at the maximum depth to make it easier for MeshLab
         to mesh a solid"""
-        mask = array != 0
-        if not leave_holes:
-            scipy.ndimage.morphology.binary_fill_holes(mask, output=mask)
-        array = depth * mask
-        
-        return self.mesh_points(array)
+        return self.band_points(depth * mask, start)
         
-    def write_header(self,f,points):
+    def write_header(self,f,count):
         f.write('ply\n')
         f.write('format ascii 1.0\n')
-        f.write('element vertex %d\n' % len(points))
+        f.write('element vertex %d\n' % count)
         f.write('property float x\n')
         f.write('property float y\n')
         f.write('property float z\n')
         f.write('end_header\n')
         
-    def write_points(self,f,points,farthest,center):
+    def write_points(self,f,bands,farthest,center):
         """writes out the points with z starting at 0"""
-        for point in points:
-            f.write('%f %f %f\n' % (point[0]-center[0],point[1]-center[1],farthest-point[2]))
+        for points in bands:
+            points[:,0] -= center[0]
+            points[:,1] -= center[1]
+            points[:,2] = farthest - points[:,2]
+            numpy.savetxt(f,points,fmt='%f')
         
 
 class FaceCube(object):
-    def __init__(self):
-        self.depth, timestamp = freenect.sync_get_depth()
+    # how much closer than the background, in raw depth units, counts as foreground
+    background_margin = 10
+    # fraction of foreground pixels at each end of the histogram treated as noise
+    noise_fraction = 0.005
+    
+    def __init__(self, depth=None):
+        """depth can be a recorded frame to work on instead of the Kinect"""
+        if depth is None:
+            import freenect
+            depth, timestamp = freenect.sync_get_depth()
+            depth = depth.transpose()
+        self.depth = depth
+        self.background = None
         self.threshold = None
         self.segmented = None
         self.selected_segment = None
@@ -152,6 +304,7 @@ class FaceCube(object):
     
     def update(self):
         """grabs a new frame from the Kinect"""
+        import freenect
         depth_rotated, timestamp = freenect.sync_get_depth()
         self.depth = depth_rotated.transpose()
         
@@ -163,6 +316,43 @@ class FaceCube(object):
         closest_cm = 100.0/(-0.00307 * closest + 3.33)
         farthest = (100/(closest_cm + face_depth) - 3.33)/-0.00307
         self.threshold = self.depth * (self.depth <= farthest)
+        
+    def learn_background(self, frames):
+        """models the empty scene as the per-pixel median of a list of frames,
+        kept as the depth each pixel has to be closer than to be foreground"""
+        median = numpy.median(numpy.array(frames), axis=0)
+        self.background = numpy.clip(median - self.background_margin, 0, 2047).astype(numpy.uint16)
+        
+    def clear_background(self):
+        self.background = None
+        
+    def generate_foreground(self):
+        """thresholds out everything in front of the learned background.  the
+        depth range is picked from a histogram of the foreground, ignoring
+        stray pixels at either end.  returns the depth of the range in cm"""
+        # recorded frames, or frames through generate_threshold, can be signed,
+        # and the range check below relies on unsigned wrap around
+        depth = self.depth.astype(numpy.uint16, copy=False)
+        foreground = depth < self.background
+        counts = numpy.bincount(depth[foreground], minlength=2048)
+        # the image breaks down when you get too close, so cap it at around 50cm
+        counts[:501] = 0
+        total = numpy.sum(counts)
+        if not total:
+            self.threshold = numpy.zeros_like(depth)
+            return 0.0
+        
+        cumulative = numpy.cumsum(counts)
+        closest = numpy.searchsorted(cumulative, total * self.noise_fraction, side='right')
+        farthest = numpy.searchsorted(cumulative, total * (1.0 - self.noise_fraction))
+        # pixels closer than closest wrap around to large values when it is
+        # subtracted, so one comparison checks both ends of the range
+        in_range = (depth - numpy.uint16(closest)) <= numpy.uint16(farthest - closest)
+        self.threshold = depth * (foreground & in_range)
+        
+        closest_cm = 100.0/(-0.00307 * closest + 3.33)
+        farthest_cm = 100.0/(-0.00307 * farthest + 3.33)
+        return farthest_cm - closest_cm
     
     def select_segment(self,point):
         """picks a segment at a specific point.  if there is no segment there,
@@ -178,7 +368,7 @@ class FaceCube(object):
     
     def segment(self):
         """does the actual segmenting"""
-        if self.selected_segment != None:
+        if self.selected_segment is not None:
             segments, num_segments = scipy.ndimage.measurements.label(self.threshold)
             selected = segments[self.selected_segment]
             if selected:
@@ -189,11 +379,34 @@ class FaceCube(object):
     def hole_fill(self,window):
         """fills holes in the object with an adjustable window size
         bigger windows fill bigger holes, but will start to alias the object"""
-        if self.segmented != None:
+        if self.segmented is not None:
             self.segmented = scipy.ndimage.morphology.grey_closing(self.segmented,size=(window,window))
+    
+    def find_objects(self,min_area,near,far):
+        """picks out every segment in the thresholded image that covers at least
+        min_area pixels and sits between near and far cm from the Kinect,
+        going by its median depth.  returns a list of (bounding box, cropped
+        array) pairs, one per object"""
+        segments, num_segments = scipy.ndimage.measurements.label(self.threshold)
+        boxes = scipy.ndimage.measurements.find_objects(segments)
+        objects = []
+        
+        for label, box in enumerate(boxes, 1):
+            if box is None:
+                continue
+            mask = segments[box] == label
+            if numpy.sum(mask) < min_area:
+                continue
+            crop = self.threshold[box] * mask
+            depth_cm = 100.0/(-0.00307 * numpy.median(crop[mask]) + 3.33)
+            if depth_cm < near or depth_cm > far:
+                continue
+            objects.append((box, crop))
+            
+        return objects
             
     def get_array(self):
-        if self.segmented != None:
+        if self.segmented is not None:
             return self.segmented
         else:
             return self.threshold
@@ -206,6 +419,10 @@ def facecube_usage():
     print ' '
     print 'Up/Down      Adjusts the depth of the threshold closer or deeper'
     print '             (can still be used while paused)'
+    print 'B            Learns the background from the next few frames. Step out'
+    print '             of view first.  Once learned, everything in front of the'
+    print '             background is shown and the depth is picked automatically.'
+    print 'N            Forgets the background and goes back to Up/Down depth'
     print 'Spacebar     Pauses or unpauses capture'
     print 'Mouse Click  Click on an object to choose it and hide everything else.'
     print '             Click elsewhere to clear the selection.'
@@ -214,12 +431,18 @@ def facecube_usage():
     print '             should have holes going through it.'
     print 'S            Saves the object as a point cloud, filename.ply'
     print 'O            Outputs the object as a solid, filename.stl'
+    print 'A            Saves every object in view as its own point cloud,'
+    print '             filename_0.ply, filename_1.ply, ...'
+    print '             Only objects 60 to 120 cm from the Kinect are saved.'
+    print 'L            Outputs every object in view as its own solid,'
+    print '             filename_0.stl, filename_1.stl, ...'
     print 'P            Saves a screenshot as filename.png'
         
 def save_ply(facecube, filename, donut):
     print "Saving array as %s.ply..." % filename
     writer = PlyWriter(filename + '.ply')
-    size = writer.save(facecube.get_array(),donut)
+    array = facecube.get_array()
+    size = writer.save(array,donut,(0,0),array.shape)
     print "done. size " + repr(size)
     return size
     
@@ -230,6 +453,32 @@ def save_stl(filename):
     subprocess.call(["meshlabserver","-i", filename+".obj","-o",filename+".stl","-s",sys.path[0]+"/meshing_simplifyb.mlx"])
     print "done"
     
+def save_object(job):
+    """saves a single cropped object, run in a worker process by save_objects"""
+    (array, offset, resolution, filename, donut, solid) = job
+    writer = PlyWriter(filename + '.ply')
+    size = writer.save(array,donut,offset,resolution)
+    if solid:
+        save_stl(filename)
+    return size
+    
+def save_objects(facecube, filename, donut, min_area, near, far, solid=False):
+    """saves every object in view at once, each in its own process"""
+    objects = facecube.find_objects(min_area, near, far)
+    print "Saving %d objects as %s_N.ply..." % (len(objects), filename)
+    names = ['%s_%d' % (filename, i) for i in range(len(objects))]
+    jobs = [(crop, (box[0].start, box[1].start), facecube.threshold.shape, name, donut, solid)
+            for ((box, crop), name) in zip(objects, names)]
+    
+    pool = multiprocessing.Pool()
+    sizes = pool.map(save_object, jobs)
+    pool.close()
+    pool.join()
+    
+    for (name, size) in zip(names, sizes):
+        print "saved %s size %s" % (name, repr(size))
+    return sizes
+    
 if __name__ == '__main__':
     import pygame
     from pygame.locals import *
@@ -239,6 +488,15 @@ if __name__ == '__main__':
     pygame.init()
     display = pygame.display.set_mode(size, 0)
     face_depth = 10.0
+    # objects smaller than this many pixels are ignored when saving everything
+    min_area = 400
+    # only objects this many cm from the Kinect are saved when saving everything,
+    # so stray things in front of or behind where people stand are left out
+    near_object = 60.0
+    far_object = 120.0
+    # number of empty frames to learn the background from
+    background_length = 30
+    background_frames = None
     facecube = FaceCube()
     going = True
     capturing = True
@@ -262,6 +520,12 @@ if __name__ == '__main__':
                     changing_depth = -1.0
                 elif e.key == K_SPACE:
                     capturing = not capturing
+                elif e.key == K_b:
+                    background_frames = []
+                    print "Learning background, keep out of view..."
+                elif e.key == K_n:
+                    facecube.clear_background()
+                    print "Background cleared"
                 elif e.key == K_h:
                     hole_filling += 1
                     print "Hole filling window set to %d" % hole_filling
@@ -279,6 +543,10 @@ if __name__ == '__main__':
                 elif e.key == K_o:
                     save_ply(facecube, filename, donut)
                     save_stl(filename)
+                elif e.key == K_a:
+                    save_objects(facecube, filename, donut, min_area, near_object, far_object)
+                elif e.key == K_l:
+                    save_objects(facecube, filename, donut, min_area, near_object, far_object, True)
                 elif e.key == K_p:
                     screenshot = pygame.surfarray.make_surface(facecube.get_array())
                     pygame.image.save(screenshot,filename + '.png')
@@ -307,10 +575,19 @@ if __name__ == '__main__':
                 
         if capturing:
             facecube.update()
+            
+        if background_frames is not None and capturing:
+            background_frames.append(facecube.depth)
+            if len(background_frames) >= background_length:
+                facecube.learn_background(background_frames)
+                background_frames = None
+                print "done"
         
-        face_depth = min(max(0.0,face_depth + changing_depth),2047.0)
-        
-        facecube.generate_threshold(face_depth)
+        if facecube.background is not None:
+            face_depth = facecube.generate_foreground()
+        else:
+            face_depth = min(max(0.0,face_depth + changing_depth),2047.0)
+            facecube.generate_threshold(face_depth)
         facecube.segment()
         if hole_filling:
             facecube.hole_fill(hole_filling)
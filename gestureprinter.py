@@ -10,12 +10,17 @@ import Queue
 import RepRapArduinoSerialSender
 
 class GCodeGenerator(object):
-    def __init__(self):
+    def __init__(self, sender=None, verbose=True):
+        """sender defaults to a RepRap on /dev/ttyUSB0, but anything with a
+        write method will do"""
         self.q = Queue.Queue()
         self.running = True
+        self.verbose = verbose
         self.sendqueue = threading.Thread(target=self.send_move)
-        self.sender = RepRapArduinoSerialSender.RepRapArduinoSerialSender("/dev/ttyUSB0", 115200, True)
-        self.sender.reset()
+        if sender is None:
+            sender = RepRapArduinoSerialSender.RepRapArduinoSerialSender("/dev/ttyUSB0", 115200, True)
+            sender.reset()
+        self.sender = sender
         self.feedrate = 4200
         self.base_feedrate = 2100
         self.z_feedrate = 60
@@ -89,7 +94,8 @@ class GCodeGenerator(object):
     def send_move(self):
         while self.running or not self.q.empty():
             move = self.q.get()
-            print move
+            if self.verbose:
+                print move
             self.sender.write(move)
             # TODO: retract when the queue runs dry
             self.q.task_done()
@@ -100,7 +106,8 @@ class GCodeGenerator(object):
         self.q.put('M140 S0')
         self.q.put('M84')
         self.running = False
-        print 'Disconnecting. %d moves left' % self.q.qsize()
+        if self.verbose:
+            print 'Disconnecting. %d moves left' % self.q.qsize()
         self.q.join()
         
 
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""Tests for the parts of facecube.py that don't need a Kinect
+
+Usage: python -m unittest test_facecube
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+import numpy
+import scipy.ndimage
+from facecube import FaceCube, PlyWriter, save_objects
+
+# saves a frame scale times the size of a Kinect frame in a fresh interpreter
+# and prints how far the peak RSS went above the RSS before the save, in KB.
+# the current RSS is the baseline, since the peak so far could already
+# include freed temporaries that would hide growth during the save
+measure_save = """
+import os, resource, numpy, facecube
+scale = %d
+frame = numpy.zeros((640 * scale, 480 * scale), numpy.uint16)
+frame[100 * scale:500 * scale,100 * scale:400 * scale] = 800
+frame[200 * scale:300 * scale,200 * scale:300 * scale] = 0
+# a cold save, so building the cached rays is measured too
+facecube.PlyWriter.ray_cache = None
+facecube.PlyWriter.ray_cache_key = None
+writer = facecube.PlyWriter(os.devnull)
+statm = open('/proc/self/statm')
+before = int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024
+statm.close()
+writer.save(frame, False)
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print after - before, frame.nbytes / 1024
+"""
+
+def save_growth(scale):
+    output = subprocess.Popen([sys.executable, '-c', measure_save % scale],
+                              stdout=subprocess.PIPE,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+    (growth, frame_size) = output.split()
+    return (int(growth), int(frame_size))
+
+def ring_frame():
+    """a ring with a hole spanning many bands, a U open to the bottom edge
+    and speckled holes"""
+    random = numpy.random.RandomState(0)
+    frame = numpy.zeros((640, 480), numpy.uint16)
+    frame[100:400,100:300] = 800
+    frame[150:350,150:250] = 0
+    frame[450:600,50:200] = 750
+    frame[470:640,90:160] = 0
+    frame[20:80,300:460] = 760
+    frame[20:80,300:460][random.random_sample((60, 160)) < 0.3] = 0
+    return frame
+
+def read(filename):
+    f = open(filename)
+    contents = f.read()
+    f.close()
+    return contents
+
+def blob_frame():
+    """a single blob off the center of the frame"""
+    frame = numpy.zeros((640, 480), numpy.uint16)
+    frame[400:520,60:200] = 760
+    frame[430:490,90:170] = 720
+    return frame
+
+class PlyWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/statm'), 'needs /proc to read the current RSS')
+    def test_peak_memory_flat_with_frame_size(self):
+        (small_growth, small_frame) = save_growth(1)
+        (large_growth, large_frame) = save_growth(3)
+        # the old writer grew by around three times the frame
+        self.assertTrue(large_growth - small_growth < (large_frame - small_frame) / 2,
+                        'peak RSS grew %d KB at 1x and %d KB at 3x' % (small_growth, large_growth))
+
+    def test_banded_hole_filling_matches_whole_image(self):
+        frame = ring_frame()
+        expected = scipy.ndimage.morphology.binary_fill_holes(frame != 0)
+        for band_pixels in (480, 3 * 480, 32 * 480):
+            writer = PlyWriter(os.devnull)
+            writer.band_pixels = band_pixels
+            writer.dims = frame.shape
+            writer.holes = writer.find_holes(frame)
+            filled = numpy.vstack([mask for (start, end, mask) in writer.filled_bands(frame)])
+            self.assertTrue(numpy.all(filled == expected), 'band_pixels %d' % band_pixels)
+
+    def test_ray_cache_reused_until_intrinsics_or_resolution_change(self):
+        PlyWriter.ray_cache = None
+        PlyWriter.ray_cache_key = None
+        writer = PlyWriter(os.path.join(self.directory, 'a.ply'))
+        rays = writer.ray_vectors((640, 480))
+        writer.save(blob_frame(), False)
+        other = PlyWriter(os.path.join(self.directory, 'b.ply'))
+        other.save(blob_frame(), False)
+        self.assertTrue(other.ray_vectors((640, 480)) is rays)
+
+        other.fx = 600.0
+        refocused = other.ray_vectors((640, 480))
+        self.assertTrue(refocused is not rays)
+        self.assertTrue(other.ray_vectors((640, 480)) is refocused)
+        self.assertTrue(other.ray_vectors((1280, 960)) is not refocused)
+
+    def test_pinhole_back_projection(self):
+        writer = PlyWriter(os.devnull)
+        (writer.x_rays, writer.y_rays) = writer.ray_vectors((640, 480))
+        (x, y) = writer.to_world((500, 100), 1000.0)
+        self.assertAlmostEqual(x, (500 - 339.31) / 594.21 * 1000.0)
+        self.assertAlmostEqual(y, (100 - 242.74) / 591.04 * 1000.0)
+
+    def test_intrinsics_scale_with_resolution(self):
+        writer = PlyWriter(os.devnull)
+        (fx, fy, cx, cy) = writer.intrinsics((1280, 960))
+        self.assertAlmostEqual(fx, 2 * 594.21)
+        self.assertAlmostEqual(fy, 2 * 591.04)
+        self.assertAlmostEqual(cx, 2 * 339.31 + 0.5)
+        self.assertAlmostEqual(cy, 2 * 242.74 + 0.5)
+        self.assertRaises(ValueError, writer.intrinsics, (480, 640))
+        self.assertRaises(ValueError, writer.intrinsics, (640, 640))
+
+    def test_crop_saves_like_full_frame(self):
+        frame = blob_frame()
+        full = os.path.join(self.directory, 'full.ply')
+        crop = os.path.join(self.directory, 'crop.ply')
+        full_size = PlyWriter(full).save(frame, False)
+        crop_size = PlyWriter(crop).save(frame[400:520,60:200], False, (400, 60), frame.shape)
+        self.assertEqual(full_size, crop_size)
+        self.assertEqual(read(full), read(crop))
+
+def depth_cm(depth):
+    return 100.0/(-0.00307 * depth + 3.33)
+
+def empty_frames():
+    """a wall at 950 with a little jitter, as the Kinect sees an empty booth"""
+    random = numpy.random.RandomState(0)
+    return [950 + random.randint(-2, 3, (64, 48)).astype(numpy.uint16) for i in range(5)]
+
+def object_frame():
+    """the empty booth with an object 700 to 740 deep in front of the wall"""
+    frame = empty_frames()[0].copy()
+    frame[10:51,10:30] = numpy.arange(700, 741)[:,numpy.newaxis]
+    return frame
+
+class FaceCubeTest(unittest.TestCase):
+    def foreground(self, frame):
+        facecube = FaceCube(frame)
+        facecube.learn_background(empty_frames())
+        return (facecube.generate_foreground(), facecube.threshold)
+
+    def test_range_matches_object(self):
+        (face_depth, threshold) = self.foreground(object_frame())
+        self.assertAlmostEqual(face_depth, depth_cm(740) - depth_cm(700))
+        self.assertTrue(numpy.all(threshold[10:51,10:30] == object_frame()[10:51,10:30]))
+
+    def test_background_excluded(self):
+        (face_depth, threshold) = self.foreground(object_frame())
+        threshold[10:51,10:30] = 0
+        self.assertEqual(numpy.count_nonzero(threshold), 0)
+
+    def test_stray_pixel_ignored(self):
+        frame = object_frame()
+        frame[60,40] = 520
+        (face_depth, threshold) = self.foreground(frame)
+        self.assertAlmostEqual(face_depth, depth_cm(740) - depth_cm(700))
+        self.assertEqual(threshold[60,40], 0)
+
+    def test_empty_foreground(self):
+        (face_depth, threshold) = self.foreground(empty_frames()[1])
+        self.assertEqual(face_depth, 0.0)
+        self.assertEqual(numpy.count_nonzero(threshold), 0)
+
+    def test_signed_frames(self):
+        frame = object_frame()
+        frame[60,40] = 520
+        frame[61,40] = 300
+        (face_depth, expected) = self.foreground(frame)
+        for dtype in (numpy.int32, numpy.int64):
+            (signed_depth, threshold) = self.foreground(frame.astype(dtype))
+            self.assertEqual(signed_depth, face_depth)
+            self.assertTrue(numpy.all(threshold == expected), str(dtype))
+
+def blobs_frame():
+    """an L shaped object with a second object inside its bounding box, and
+    blobs that are too small, too close and too far to save"""
+    frame = numpy.zeros((640, 480), numpy.uint16)
+    frame[100:300,100:140] = 700
+    frame[260:300,100:300] = 700
+    frame[150:200,180:260] = 720
+    frame[400:405,400:405] = 700
+    frame[400:500,20:100] = 520
+    frame[500:600,300:400] = 900
+    return frame
+
+class FindObjectsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.facecube = FaceCube(blobs_frame())
+        self.facecube.threshold = blobs_frame()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_large_objects_in_range(self):
+        objects = self.facecube.find_objects(400, 60.0, 120.0)
+        boxes = [box for (box, crop) in objects]
+        self.assertEqual(boxes, [(slice(100, 300), slice(100, 300)),
+                                 (slice(150, 200), slice(180, 260))])
+
+    def test_crops_only_hold_their_own_object(self):
+        ((outer_box, outer), (inner_box, inner)) = self.facecube.find_objects(400, 60.0, 120.0)
+        expected = blobs_frame()[outer_box] * (blobs_frame()[outer_box] == 700)
+        self.assertTrue(numpy.all(outer == expected))
+        self.assertTrue(numpy.all(inner == 720))
+
+    def test_save_objects_writes_each_object(self):
+        filename = os.path.join(self.directory, 'object')
+        sizes = save_objects(self.facecube, filename, False, 400, 60.0, 120.0)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['object_0.ply', 'object_1.ply'])
+        for (i, (box, crop)) in enumerate(self.facecube.find_objects(400, 60.0, 120.0)):
+            writer = PlyWriter(os.path.join(self.directory, 'expected.ply'))
+            offset = (box[0].start, box[1].start)
+            self.assertEqual(sizes[i], writer.save(crop, False, offset, (640, 480)))
+            self.assertEqual(read(filename + '_%d.ply' % i),
+                             read(os.path.join(self.directory, 'expected.ply')))
+
+if __name__ == '__main__':
+    unittest.main()